@@ -7,12 +7,34 @@ import sounddevice as sd
 import numpy as np
 import pyperclip
 import subprocess
+import shutil
 from pathlib import Path
 import time
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import logging
-from datetime import datetime
+import threading
+import concurrent.futures
+import signal
+import copy
+import functools
+import pickle
+from collections import OrderedDict
+
+try:
+    import httpx
+    NETWORK_ERRORS = (requests.exceptions.RequestException, httpx.HTTPError)
+except ImportError:
+    httpx = None
+    NETWORK_ERRORS = (requests.exceptions.RequestException,)
+
+try:
+    from Xlib import X, XK, display as xdisplay
+    from Xlib.ext import xtest
+    HAS_XLIB = True
+except ImportError:
+    HAS_XLIB = False
 
 # Configure logging
 logging.basicConfig(
@@ -25,38 +47,143 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+try:
+    from yaml import CSafeLoader as _Loader, CSafeDumper as _Dumper
+except ImportError:
+    from yaml import SafeLoader as _Loader, SafeDumper as _Dumper
+
+_DEFAULT_CONFIG = {
+    "server_url": "http://localhost:8000",
+    "hotkey": "<ctrl>+<alt>+<space>",
+    "output_mode": "clipboard",
+    "audio_device": "default",
+    "api_key": None,
+    "record_on_press": False,
+    "streaming": True,
+    "silence_threshold_db": -40,
+    "type_delay": 0,
+    "http2": False
+}
+
+# Recordings shorter than this are treated as accidental taps and never uploaded
+MIN_RECORDING_SECONDS = 0.2
+
+# Parsed YAML files keyed by path -> (st_mtime, st_size, config)
+_YAML_CACHE = OrderedDict()
+_YAML_CACHE_SIZE = 100
+
+def _trim_silence(x, thr_db=-40, hop=512):
+    """Strip leading/trailing int16 frames whose RMS is below thr_db (dBFS), keeping one frame of margin.
+    
+    A thr_db of None disables trimming.
+    """
+    if thr_db is None:
+        return x
+    n_frames = len(x) // hop
+    if n_frames == 0:
+        return x
+    frames = x[:n_frames * hop].reshape(-1, hop)
+    # Per-frame sum of squares in one pass, without float copies of the recording
+    rms = np.sqrt(np.einsum("ij,ij->i", frames, frames, dtype=np.float64) / hop)
+    voiced = np.flatnonzero(rms > 10 ** (thr_db / 20) * 32768)
+    if voiced.size == 0:
+        return x[:0]
+    start = max(voiced[0] - 1, 0) * hop
+    end = len(x) if voiced[-1] + 2 >= n_frames else (voiced[-1] + 2) * hop
+    return x[start:end]
+
+def _load_yaml_pickled(path, st):
+    """Load a YAML file via its pickled sidecar when that was made from this exact version of it.
+    
+    The sidecar records the YAML's mtime and size; an ordering check alone would keep serving
+    a stale sidecar after an older config is restored with its timestamps (cp -p, rsync -t).
+    """
+    pkl_path = path + ".pkl"
+    source = (st.st_mtime_ns, st.st_size)
+    try:
+        with open(pkl_path, "rb") as f:
+            cached_source, config = pickle.load(f)
+        if cached_source == source:
+            return config
+    except Exception:
+        pass  # Missing, unreadable or old-format sidecar, parse the YAML instead
+    
+    with open(path) as f:
+        config = yaml.load(f, Loader=_Loader)
+    try:
+        tmp_path = pkl_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump((source, config), f, protocol=5)
+        os.replace(tmp_path, pkl_path)
+    except OSError as e:
+        logger.debug(f"Couldn't write config cache {pkl_path}: {e}")
+    return config
+
+def _load_yaml_cached(path):
+    """Parse a YAML file, reusing the cached result while mtime and size are unchanged"""
+    st = os.stat(path)
+    cached = _YAML_CACHE.get(path)
+    if cached is not None and cached[0] == st.st_mtime and cached[1] == st.st_size:
+        _YAML_CACHE.move_to_end(path)
+        return copy.deepcopy(cached[2])
+    
+    config = _load_yaml_pickled(path, st)
+    _YAML_CACHE[path] = (st.st_mtime, st.st_size, config)
+    _YAML_CACHE.move_to_end(path)
+    if len(_YAML_CACHE) > _YAML_CACHE_SIZE:
+        _YAML_CACHE.popitem(last=False)
+    return copy.deepcopy(config)
+
+class _Take:
+    """One recording's capture state, handed to its upload when the recording stops"""
+    def __init__(self, size):
+        self.buf = np.empty(size, dtype=np.int16)
+        self.pos = 0
+        self.done = threading.Event()
+    
+    def grow(self, min_size):
+        """Reallocate the buffer with at least min_size samples"""
+        new_buf = np.empty(max(min_size, self.buf.size * 2), dtype=np.int16)
+        new_buf[:self.pos] = self.buf[:self.pos]
+        self.buf = new_buf
+
 class STTClient:
     def __init__(self):
         self.config = self.load_config()
         self.is_recording = False
-        self.audio_data = []
         self.sample_rate = 16000
+        # Capture state for the next recording: a contiguous int16 buffer (10 minutes),
+        # grown on demand by the audio callback
+        self._take = _Take(self.sample_rate * 600)
+        self._silence_db = self.config.get("silence_threshold_db", -40)
+        # Reuse one keep-alive connection to the server across transcriptions
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        # Optional HTTP/2 client multiplexes overlapping transcriptions over one connection
+        self.http2_client = self.open_http2_client()
+        # Uploads run off the hotkey thread; the lock keeps overlapping results from racing for output
+        self._exec = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="stt-net")
+        self._output_lock = threading.Lock()
+        self._x = self.open_display()
+        self._output_chain = self.build_output_chain()
         
     def load_config(self):
         config_path = os.path.expanduser("~/.config/stt_client/config.yaml")
         try:
             os.makedirs(os.path.dirname(config_path), exist_ok=True)
             if not os.path.exists(config_path):
-                default_config = {
-                    "server_url": "http://localhost:8000",
-                    "hotkey": "<ctrl>+<alt>+<space>",
-                    "output_mode": "clipboard",
-                    "audio_device": "default",
-                    "api_key": None,
-                    "record_on_press": False
-                }
                 with open(config_path, "w") as f:
-                    yaml.dump(default_config, f)
-                return default_config
+                    yaml.dump(_DEFAULT_CONFIG, f, Dumper=_Dumper)
+                return _DEFAULT_CONFIG.copy()
             
-            with open(config_path) as f:
-                config = yaml.safe_load(f)
-                if isinstance(config['hotkey'], str) and 'space' in config['hotkey'] and '<space>' not in config['hotkey']:
-                    config['hotkey'] = config['hotkey'].replace('space', '<space>')
-                return config
+            config = _load_yaml_cached(config_path)
+            if isinstance(config['hotkey'], str) and 'space' in config['hotkey'] and '<space>' not in config['hotkey']:
+                config['hotkey'] = config['hotkey'].replace('space', '<space>')
+            return config
         except Exception as e:
-            logger.error(f"Error loading config: {e}")
-            return self.load_config()
+            logger.error(f"Error loading config: {e}, using defaults")
+            return _DEFAULT_CONFIG.copy()
     
     def toggle_recording(self):
         if self.is_recording:
@@ -66,101 +193,303 @@ class STTClient:
     
     def start_recording(self):
         self.is_recording = True
-        self.audio_data = []
+        take = self._take
         logger.info("Recording started... (Press hotkey again to stop)")
         
         def callback(indata, frames, time, status):
             if status:
                 logger.warning(f"Audio stream status: {status}")
-            self.audio_data.append(indata.copy())
+            end = take.pos + frames
+            if end > take.buf.size:
+                take.grow(end)
+            # Mono int16 block: reshape is a view, so this is a single memcpy
+            take.buf[take.pos:end] = indata.reshape(-1)
+            take.pos = end
         
         try:
             self.stream = sd.InputStream(
                 samplerate=self.sample_rate,
                 channels=1,
-                dtype="float32",
+                dtype="int16",
                 device=self.config["audio_device"],
                 callback=callback
             )
             self.stream.start()
             logger.debug("Audio stream started successfully")
+            
+            if self.config.get("streaming", True):
+                # Upload while recording so the server has the audio as soon as we stop
+                self._exec.submit(self.process_audio, self.stream_chunks(take))
         except Exception as e:
             logger.error(f"Failed to start audio stream: {e}")
             self.is_recording = False
     
+    def stream_chunks(self, take):
+        """Yield the take's audio in ~100 ms slices until it is done, then the tail"""
+        chunk_size = self.sample_rate // 10
+        min_samples = int(self.sample_rate * MIN_RECORDING_SECONDS)
+        sent = 0
+        speech = False
+        while not take.done.is_set():
+            end = take.pos
+            # Hold everything back until the take is long enough not to be an accidental tap
+            if end >= min_samples and end - sent >= chunk_size:
+                if not speech and _trim_silence(take.buf[sent:end], self._silence_db).size == 0:
+                    # Drop leading silence, keeping a short pre-roll before speech starts
+                    sent = max(sent, end - 512)
+                    take.done.wait(0.05)
+                    continue
+                speech = True
+                yield memoryview(take.buf)[sent:end].tobytes()
+                sent = end
+            else:
+                take.done.wait(0.05)
+        if take.pos < min_samples:
+            return  # Accidental tap, nothing was sent so the request is skipped
+        tail = take.buf[sent:take.pos]
+        if not speech:
+            tail = _trim_silence(tail, self._silence_db)
+            if not tail.size:
+                self.notify_no_speech()
+                return
+        if tail.size:
+            yield tail.tobytes()
+    
     def stop_recording(self):
         if not self.is_recording:
             return
             
         self.is_recording = False
+        # Hand this take to its upload and record the next one into a fresh buffer, so an
+        # upload still draining it never sees the next recording, even if stopping the stream fails
+        take = self._take
+        self._take = _Take(take.buf.size)
         try:
             self.stream.stop()
             self.stream.close()
             logger.info("Recording stopped. Processing...")
             
-            audio_array = np.concatenate(self.audio_data)
-            audio_array = audio_array.flatten().astype(np.float32)
+            audio_array = take.buf[:take.pos]
             
             logger.debug(f"Audio data shape: {audio_array.shape}, duration: {len(audio_array)/self.sample_rate:.2f}s")
             
-            self.process_audio(audio_array)
+            if not self.config.get("streaming", True):
+                if take.pos < int(self.sample_rate * MIN_RECORDING_SECONDS):
+                    logger.info("Recording too short, skipping")
+                    return
+                audio_array = _trim_silence(audio_array, self._silence_db)
+                if not audio_array.size:
+                    self.notify_no_speech()
+                    return
+                logger.debug(f"Sending {len(audio_array)/self.sample_rate:.2f}s after trimming silence")
+                # The take is no longer written to, so the body can be a zero-copy view
+                self._exec.submit(self.process_audio, memoryview(audio_array).cast("B"))
         except Exception as e:
             logger.error(f"Error stopping recording: {e}")
+        finally:
+            # End the take in every case, or a streaming upload would wait on it forever
+            take.done.set()
+    
+    def notify_no_speech(self):
+        """Tell the user a take was dropped because it never rose above the silence threshold"""
+        logger.warning(
+            f"No speech above {self._silence_db} dBFS, skipping "
+            "(lower silence_threshold_db for a quiet mic, or set it to null to disable trimming)"
+        )
+    
+    def send_request(self, method, path, data=None, headers=None, timeout=None):
+        """Send through the HTTP/2 client when enabled, otherwise the pooled requests session"""
+        if self.http2_client is not None:
+            if isinstance(data, memoryview):
+                data = data.tobytes()  # httpx would iterate a memoryview as ints
+            return self.http2_client.request(method, path, content=data, headers=headers, timeout=timeout)
+        return self.session.request(
+            method,
+            f"{self.config['server_url']}{path}",
+            data=data,
+            headers=headers,
+            timeout=timeout
+        )
+    
+    def open_http2_client(self):
+        if not self.config.get("http2", False):
+            return None
+        if httpx is None:
+            logger.warning("http2 is enabled but httpx is not installed, using HTTP/1.1")
+            return None
+        try:
+            return httpx.Client(http2=True, base_url=self.config["server_url"])
+        except ImportError:
+            logger.warning("http2 needs the h2 package (pip install 'httpx[http2]'), using HTTP/1.1")
+            return None
     
-    def process_audio(self, audio_array):
+    def process_audio(self, data):
+        """POST audio to the server; data is a bytes-like body or an iterator of chunks (sent chunked)"""
         try:
-            headers = {'Content-Type': 'application/octet-stream'}
+            sent_ns = []
+            if not isinstance(data, (bytes, memoryview)):
+                # Only open the request once the stream has produced audio
+                first_chunk = next(data, None)
+                if first_chunk is None:
+                    logger.info("Recording too short or silent, skipping")
+                    return
+                chunks = data
+                def body():
+                    yield first_chunk
+                    yield from chunks
+                    # Recording stopped and fully sent: the server's time starts here
+                    sent_ns.append(time.perf_counter_ns())
+                data = body()
+            
+            headers = {'Content-Type': 'application/octet-stream', 'X-Sample-Format': 's16le'}
             if self.config["api_key"]:
                 headers["x-api-key"] = self.config["api_key"]
             
             logger.debug(f"Sending audio to {self.config['server_url']}/transcribe")
             
-            start_time = datetime.now()
-            response = requests.post(
-                f"{self.config['server_url']}/transcribe",
-                data=audio_array.tobytes(),
+            start_ns = time.perf_counter_ns()
+            response = self.send_request(
+                "POST",
+                "/transcribe",
+                data=data,
                 headers=headers
             )
             
             response.raise_for_status()
-            processing_time = (datetime.now() - start_time).total_seconds()
+            processing_time = (time.perf_counter_ns() - (sent_ns[-1] if sent_ns else start_ns)) / 1e9
             logger.info(f"Server response time: {processing_time:.2f}s")
             
             result = response.json()
             text = result.get("text", "")
             logger.info(f"Transcription: {text}")
-            self.handle_output(text)
-        except requests.exceptions.RequestException as e:
+            with self._output_lock:
+                self.handle_output(text)
+        except NETWORK_ERRORS as e:
             logger.error(f"HTTP request error: {e}")
-            if e.response is not None:
+            if getattr(e, "response", None) is not None:
                 logger.error(f"Server response: {e.response.text}")
         except Exception as e:
             logger.error(f"Error during transcription: {e}")
     
+    def warm_connection(self):
+        """Open the pooled connection up front so the first transcription skips the handshake"""
+        try:
+            self.send_request("GET", "/health", timeout=5)
+        except NETWORK_ERRORS as e:
+            logger.warning(f"Server not reachable yet: {e}")
+    
+    def open_display(self):
+        """Open the X connection used for XTest typing once, or None if unavailable"""
+        if not HAS_XLIB or os.getenv("XDG_SESSION_TYPE") != "x11":
+            return None
+        try:
+            return xdisplay.Display()
+        except Exception as e:
+            logger.warning(f"Couldn't open X display, using xdotool: {e}")
+            return None
+    
+    def xtest_type(self, text):
+        """Type text with XTest fake key events.
+        
+        Returns False, leaving the text to xdotool, if a character needs more than Shift or a
+        keyboard layout other than the first XKB group is active.
+        """
+        # Core key events carry the XKB group in state bits 13-14; the keycodes below are only
+        # right for group 1, another layout would turn them into its own symbols
+        if (self._x.screen().root.query_pointer().mask >> 13) & 3:
+            return False
+        # MappingNotify is sent to every client; apply any queued ones so a layout change
+        # (setxkbmap) since startup reaches python-xlib's keymap cache
+        while self._x.pending_events():
+            event = self._x.next_event()
+            if event.type == X.MappingNotify:
+                self._x.refresh_keyboard_mapping(event)
+        
+        keys = []
+        for ch in text:
+            code = ord(ch)
+            if ch == "\n":
+                keysym = XK.XK_Return
+            elif ch == "\t":
+                keysym = XK.XK_Tab
+            elif code < 0x100:
+                keysym = code  # Latin-1 keysyms match their codepoints
+            else:
+                keysym = 0x01000000 | code
+            keycodes = sorted(self._x.keysym_to_keycodes(keysym), key=lambda k: k[1])
+            # Index 0/1 is the plain/Shift level; anything higher needs Mode_switch or AltGr
+            # (e.g. @ on a German layout), which xdotool handles
+            if not keycodes or keycodes[0][1] > 1:
+                return False
+            keycode, index = keycodes[0]
+            keys.append((keycode, index % 2 == 1))
+        
+        shift = self._x.keysym_to_keycode(XK.XK_Shift_L)
+        for keycode, shifted in keys:
+            if shifted:
+                xtest.fake_input(self._x, X.KeyPress, shift)
+            xtest.fake_input(self._x, X.KeyPress, keycode)
+            xtest.fake_input(self._x, X.KeyRelease, keycode)
+            if shifted:
+                xtest.fake_input(self._x, X.KeyRelease, shift)
+        self._x.sync()
+        return True
+    
+    def build_output_chain(self):
+        """Resolve output mode and session type once so handle_output only runs the chain"""
+        mode = self.config["output_mode"]
+        self._do_clipboard = mode in ("clipboard", "both")
+        self._type_delay = self.config.get("type_delay", 0)
+        
+        chain = []
+        if self._do_clipboard:
+            chain.append(self.copy_to_clipboard)
+        if mode in ("type", "both"):
+            session_type = os.getenv("XDG_SESSION_TYPE")
+            if session_type == "x11":
+                chain.append(functools.partial(self.type_text, self.type_x11))
+            elif session_type == "wayland" and shutil.which("wtype"):
+                chain.append(functools.partial(self.type_text, self.type_wayland))
+            else:
+                logger.warning("Auto-typing requires X11 (or wtype on Wayland). Falling back to clipboard.")
+                if not self._do_clipboard:
+                    chain.append(self.copy_to_clipboard)
+        return chain
+    
+    def copy_to_clipboard(self, text):
+        pyperclip.copy(text)
+        logger.info("Text copied to clipboard")
+    
+    def type_text(self, typer, text):
+        try:
+            # Optional settle time for window managers that need focus to catch up
+            if self._type_delay:
+                time.sleep(self._type_delay)
+            typer(text)
+        except Exception as e:
+            logger.error(f"Error typing text: {e}")
+            if not self._do_clipboard:
+                pyperclip.copy(text)
+    
+    def type_x11(self, text):
+        if self._x is not None and self.xtest_type(text):
+            logger.info("Text typed using XTest")
+        else:
+            subprocess.run(["xdotool", "type", "--delay", "0", text], check=True, env=os.environ)
+            logger.info("Text typed using xdotool")
+    
+    def type_wayland(self, text):
+        subprocess.run(["wtype", text], check=True, env=os.environ)
+        logger.info("Text typed using wtype")
+    
     def handle_output(self, text):
         try:
             if not text:
                 logger.warning("Empty transcription received")
                 return
-                
-            if self.config["output_mode"] in ["clipboard", "both"]:
-                pyperclip.copy(text)
-                logger.info("Text copied to clipboard")
             
-            if self.config["output_mode"] in ["type", "both"]:
-                if os.getenv("XDG_SESSION_TYPE") == "x11":
-                    try:
-                        subprocess.run(["sleep", "0.1"])
-                        subprocess.run(["xdotool", "type", "--delay", "0", text], check=True)
-                        logger.info("Text typed using xdotool")
-                    except Exception as e:
-                        logger.error(f"Error using xdotool: {e}")
-                        if self.config["output_mode"] != "both":
-                            pyperclip.copy(text)
-                else:
-                    logger.warning("xdotool requires X11. Falling back to clipboard.")
-                    if self.config["output_mode"] == "type":
-                        pyperclip.copy(text)
+            for output in self._output_chain:
+                output(text)
         except Exception as e:
             logger.error(f"Error handling output: {e}")
     
@@ -176,8 +505,12 @@ class STTClient:
             logger.info(f"Configuration: {self.config}")
             
             listener.start()
-            while True:
-                time.sleep(0.1)
+            self.warm_connection()
+            # Block until interrupted or terminated instead of polling
+            self._stop = threading.Event()
+            signal.signal(signal.SIGTERM, lambda *_: self._stop.set())
+            self._stop.wait()
+            logger.info("Terminated, exiting...")
         except ValueError as e:
             logger.error(f"Invalid hotkey format in config: {self.config['hotkey']}")
             logger.error("Edit ~/.config/stt_client/config.yaml to fix this")
@@ -185,6 +518,9 @@ class STTClient:
             logger.info("Exiting...")
         except Exception as e:
             logger.error(f"Unexpected error: {e}")
+        finally:
+            # Let an in-flight streaming upload finish so the executor can shut down
+            self._take.done.set()
 
 def configure():
     config_path = os.path.expanduser("~/.config/stt_client/config.yaml")
@@ -213,7 +549,7 @@ def configure():
     config["record_on_press"] = False
     
     with open(config_path, "w") as f:
-        yaml.dump(config, f)
+        yaml.dump(config, f, Dumper=_Dumper)
     
     print(f"Configuration saved to {config_path}")
 
@@ -9,11 +9,47 @@ import pyperclip
 import subprocess
 import time
 import requests
+from requests.adapters import HTTPAdapter
 import logging
-from datetime import datetime
+import threading
+import concurrent.futures
+import signal
+import copy
+import pickle
+from collections import OrderedDict
 import platform
 import sys
 
+try:
+    import httpx
+    NETWORK_ERRORS = (requests.exceptions.RequestException, httpx.HTTPError)
+except ImportError:
+    httpx = None
+    NETWORK_ERRORS = (requests.exceptions.RequestException,)
+
+try:
+    from Quartz import (
+        CGEventCreateKeyboardEvent,
+        CGEventKeyboardSetUnicodeString,
+        CGEventPost,
+        kCGHIDEventTap
+    )
+    HAS_QUARTZ = True
+except ImportError:
+    HAS_QUARTZ = False
+
+try:
+    from Foundation import NSUserNotification, NSUserNotificationCenter
+    from AppKit import NSSound
+    HAS_COCOA = True
+except ImportError:
+    HAS_COCOA = False
+
+SOUND_FILES = {
+    "start": "/System/Library/Sounds/Ping.aiff",
+    "stop": "/System/Library/Sounds/Pop.aiff"
+}
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -25,14 +61,153 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+try:
+    from yaml import CSafeLoader as _Loader, CSafeDumper as _Dumper
+except ImportError:
+    from yaml import SafeLoader as _Loader, SafeDumper as _Dumper
+
+_DEFAULT_CONFIG = {
+    "server_url": "http://192.168.1.11:8000",
+    "hotkey": "<cmd>+<space>",
+    "output_mode": "clipboard",
+    "audio_device": "default",
+    "api_key": None,
+    "notifications": True,
+    "sound_effects": True,
+    "streaming": True,
+    "silence_threshold_db": -40,
+    "http2": False
+}
+
+# Recordings shorter than this are treated as accidental taps and never uploaded
+MIN_RECORDING_SECONDS = 0.2
+
+# Parsed YAML files keyed by path -> (st_mtime, st_size, config)
+_YAML_CACHE = OrderedDict()
+_YAML_CACHE_SIZE = 100
+
+def _trim_silence(x, thr_db=-40, hop=512):
+    """Strip leading/trailing int16 frames whose RMS is below thr_db (dBFS), keeping one frame of margin.
+    
+    A thr_db of None disables trimming.
+    """
+    if thr_db is None:
+        return x
+    n_frames = len(x) // hop
+    if n_frames == 0:
+        return x
+    frames = x[:n_frames * hop].reshape(-1, hop)
+    # Per-frame sum of squares in one pass, without float copies of the recording
+    rms = np.sqrt(np.einsum("ij,ij->i", frames, frames, dtype=np.float64) / hop)
+    voiced = np.flatnonzero(rms > 10 ** (thr_db / 20) * 32768)
+    if voiced.size == 0:
+        return x[:0]
+    start = max(voiced[0] - 1, 0) * hop
+    end = len(x) if voiced[-1] + 2 >= n_frames else (voiced[-1] + 2) * hop
+    return x[start:end]
+
+def _load_yaml_pickled(path, st):
+    """Load a YAML file via its pickled sidecar when that was made from this exact version of it.
+    
+    The sidecar records the YAML's mtime and size; an ordering check alone would keep serving
+    a stale sidecar after an older config is restored with its timestamps (cp -p, rsync -t).
+    """
+    pkl_path = path + ".pkl"
+    source = (st.st_mtime_ns, st.st_size)
+    try:
+        with open(pkl_path, "rb") as f:
+            cached_source, config = pickle.load(f)
+        if cached_source == source:
+            return config
+    except Exception:
+        pass  # Missing, unreadable or old-format sidecar, parse the YAML instead
+    
+    with open(path) as f:
+        config = yaml.load(f, Loader=_Loader)
+    try:
+        tmp_path = pkl_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump((source, config), f, protocol=5)
+        os.replace(tmp_path, pkl_path)
+    except OSError as e:
+        logger.debug(f"Couldn't write config cache {pkl_path}: {e}")
+    return config
+
+def _load_yaml_cached(path):
+    """Parse a YAML file, reusing the cached result while mtime and size are unchanged"""
+    st = os.stat(path)
+    cached = _YAML_CACHE.get(path)
+    if cached is not None and cached[0] == st.st_mtime and cached[1] == st.st_size:
+        _YAML_CACHE.move_to_end(path)
+        return copy.deepcopy(cached[2])
+    
+    config = _load_yaml_pickled(path, st)
+    _YAML_CACHE[path] = (st.st_mtime, st.st_size, config)
+    _YAML_CACHE.move_to_end(path)
+    if len(_YAML_CACHE) > _YAML_CACHE_SIZE:
+        _YAML_CACHE.popitem(last=False)
+    return copy.deepcopy(config)
+
+class _Take:
+    """One recording's capture state, handed to its upload when the recording stops"""
+    def __init__(self, size):
+        self.buf = np.empty(size, dtype=np.int16)
+        self.pos = 0
+        self.done = threading.Event()
+
+    def grow(self, min_size):
+        """Reallocate the buffer with at least min_size samples"""
+        new_buf = np.empty(max(min_size, self.buf.size * 2), dtype=np.int16)
+        new_buf[:self.pos] = self.buf[:self.pos]
+        self.buf = new_buf
+
+class WarningDetector(logging.Handler):
+    """Flag the client when pynput reports missing accessibility permissions"""
+    def __init__(self, client):
+        super().__init__()
+        self.client = client
+        
+    def emit(self, record):
+        # Check the raw format string first so unrelated records are never formatted
+        if record.levelno != logging.WARNING or "accessibility" not in str(record.msg):
+            return
+        message = record.getMessage()
+        if "not trusted" in message and "accessibility" in message:
+            self.client.accessibility_permission_warning = True
+
 class MacSTTClient:
     def __init__(self):
         self.config = self.load_config()
         self.is_recording = False
-        self.audio_data = []
         self.sample_rate = 16000
+        # Capture state for the next recording: a contiguous int16 buffer (10 minutes),
+        # grown on demand by the audio callback
+        self._take = _Take(self.sample_rate * 600)
+        self._silence_db = self.config.get("silence_threshold_db", -40)
+        # Reuse one keep-alive connection to the server across transcriptions
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        # Optional HTTP/2 client multiplexes overlapping transcriptions over one connection
+        self.http2_client = self.open_http2_client()
+        # Uploads run off the hotkey thread; the lock keeps overlapping results from racing for output
+        self._exec = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="stt-net")
+        self._output_lock = threading.Lock()
         self.accessibility_permission_warning = False
         self.python_interpreter_path = sys.executable
+        self._notifications = self.config.get('notifications', True)
+        self._sound_effects = self.config.get('sound_effects', True)
+        self._do_type = self.config["output_mode"] in ("type", "both")
+        self.notification_center = None
+        self.sounds = {}
+        if HAS_COCOA:
+            # None when Python isn't running from an app bundle; osascript is used then
+            self.notification_center = NSUserNotificationCenter.defaultUserNotificationCenter()
+            # Decode the sound effects once so play_sound only starts playback
+            self.sounds = {
+                name: NSSound.alloc().initWithContentsOfFile_byReference_(path, True)
+                for name, path in SOUND_FILES.items()
+            }
         self.check_system_compatibility()
         
     def check_system_compatibility(self):
@@ -103,46 +278,43 @@ class MacSTTClient:
         try:
             os.makedirs(os.path.dirname(config_path), exist_ok=True)
             if not os.path.exists(config_path):
-                default_config = {
-                    "server_url": "http://192.168.1.11:8000",
-                    "hotkey": "<cmd>+<space>",
-                    "output_mode": "clipboard",
-                    "audio_device": "default",
-                    "api_key": None,
-                    "notifications": True,
-                    "sound_effects": True
-                }
                 with open(config_path, 'w') as f:
-                    yaml.dump(default_config, f)
-                return default_config
+                    yaml.dump(_DEFAULT_CONFIG, f, Dumper=_Dumper)
+                return _DEFAULT_CONFIG.copy()
             
-            with open(config_path) as f:
-                config = yaml.safe_load(f)
-                return config
+            return _load_yaml_cached(config_path)
         except Exception as e:
-            logger.error(f"Error loading config: {e}")
-            return self.load_config()
+            logger.error(f"Error loading config: {e}, using defaults")
+            return _DEFAULT_CONFIG.copy()
     
     def show_notification(self, title, message):
         """Show macOS notification"""
-        if self.config.get('notifications', True):
+        if self._notifications:
             try:
-                subprocess.run([
-                    'osascript',
-                    '-e',
-                    f'display notification "{message}" with title "{title}"'
-                ])
+                if self.notification_center is not None:
+                    notification = NSUserNotification.alloc().init()
+                    notification.setTitle_(title)
+                    notification.setInformativeText_(message)
+                    self.notification_center.deliverNotification_(notification)
+                else:
+                    subprocess.run([
+                        'osascript',
+                        '-e',
+                        f'display notification "{message}" with title "{title}"'
+                    ])
             except Exception as e:
                 logger.warning(f"Couldn't show notification: {e}")
 
     def play_sound(self, sound_type):
         """Play system sound"""
-        if self.config.get('sound_effects', True):
+        if self._sound_effects:
             try:
-                if sound_type == "start":
-                    subprocess.run(['afplay', '/System/Library/Sounds/Ping.aiff'])
-                elif sound_type == "stop":
-                    subprocess.run(['afplay', '/System/Library/Sounds/Pop.aiff'])
+                sound = self.sounds.get(sound_type)
+                if sound is not None:
+                    sound.stop()
+                    sound.play()
+                elif sound_type in SOUND_FILES:
+                    subprocess.run(['afplay', SOUND_FILES[sound_type]])
             except Exception as e:
                 logger.warning(f"Couldn't play sound: {e}")
 
@@ -154,7 +326,7 @@ class MacSTTClient:
     
     def start_recording(self):
         self.is_recording = True
-        self.audio_data = []
+        take = self._take
         logger.info("Recording started...")
         self.show_notification("STT Client", "Recording started")
         self.play_sound("start")
@@ -162,92 +334,214 @@ class MacSTTClient:
         def callback(indata, frames, time, status):
             if status:
                 logger.warning(f"Audio status: {status}")
-            self.audio_data.append(indata.copy())
+            end = take.pos + frames
+            if end > take.buf.size:
+                take.grow(end)
+            # Mono int16 block: reshape is a view, so this is a single memcpy
+            take.buf[take.pos:end] = indata.reshape(-1)
+            take.pos = end
         
         try:
             self.stream = sd.InputStream(
                 samplerate=self.sample_rate,
                 channels=1,
-                dtype="float32",
+                dtype="int16",
                 device=self.config["audio_device"],
                 callback=callback
             )
             self.stream.start()
+            
+            if self.config.get("streaming", True):
+                # Upload while recording so the server has the audio as soon as we stop
+                self._exec.submit(self.process_audio, self.stream_chunks(take))
         except Exception as e:
             logger.error(f"Failed to start audio: {e}")
             self.is_recording = False
             self.show_notification("STT Error", "Failed to start recording")
 
+    def stream_chunks(self, take):
+        """Yield the take's audio in ~100 ms slices until it is done, then the tail"""
+        chunk_size = self.sample_rate // 10
+        min_samples = int(self.sample_rate * MIN_RECORDING_SECONDS)
+        sent = 0
+        speech = False
+        while not take.done.is_set():
+            end = take.pos
+            # Hold everything back until the take is long enough not to be an accidental tap
+            if end >= min_samples and end - sent >= chunk_size:
+                if not speech and _trim_silence(take.buf[sent:end], self._silence_db).size == 0:
+                    # Drop leading silence, keeping a short pre-roll before speech starts
+                    sent = max(sent, end - 512)
+                    take.done.wait(0.05)
+                    continue
+                speech = True
+                yield memoryview(take.buf)[sent:end].tobytes()
+                sent = end
+            else:
+                take.done.wait(0.05)
+        if take.pos < min_samples:
+            return  # Accidental tap, nothing was sent so the request is skipped
+        tail = take.buf[sent:take.pos]
+        if not speech:
+            tail = _trim_silence(tail, self._silence_db)
+            if not tail.size:
+                self.notify_no_speech()
+                return
+        if tail.size:
+            yield tail.tobytes()
+
     def stop_recording(self):
         if not self.is_recording:
             return
             
         self.is_recording = False
+        # Hand this take to its upload and record the next one into a fresh buffer, so an
+        # upload still draining it never sees the next recording, even if stopping the stream fails
+        take = self._take
+        self._take = _Take(take.buf.size)
         try:
             self.stream.stop()
             self.stream.close()
             logger.info("Processing recording...")
             self.show_notification("STT Client", "Processing recording")
             
-            audio_array = np.concatenate(self.audio_data)
-            audio_array = audio_array.flatten().astype(np.float32)
+            audio_array = take.buf[:take.pos]
             
             logger.debug(f"Audio length: {len(audio_array)/self.sample_rate:.2f}s")
-            self.process_audio(audio_array)
+            if not self.config.get("streaming", True):
+                if take.pos < int(self.sample_rate * MIN_RECORDING_SECONDS):
+                    logger.info("Recording too short, skipping")
+                    return
+                audio_array = _trim_silence(audio_array, self._silence_db)
+                if not audio_array.size:
+                    self.notify_no_speech()
+                    return
+                logger.debug(f"Sending {len(audio_array)/self.sample_rate:.2f}s after trimming silence")
+                # The take is no longer written to, so the body can be a zero-copy view
+                self._exec.submit(self.process_audio, memoryview(audio_array).cast("B"))
             
         except Exception as e:
             logger.error(f"Error stopping recording: {e}")
             self.show_notification("STT Error", "Recording failed")
+        finally:
+            # End the take in every case, or a streaming upload would wait on it forever
+            take.done.set()
 
-    def process_audio(self, audio_array):
+    def notify_no_speech(self):
+        """Tell the user a take was dropped because it never rose above the silence threshold"""
+        logger.warning(
+            f"No speech above {self._silence_db} dBFS, skipping "
+            "(lower silence_threshold_db for a quiet mic, or set it to null to disable trimming)"
+        )
+        self.show_notification("STT Client", "No speech detected")
+
+    def send_request(self, method, path, data=None, headers=None, timeout=None):
+        """Send through the HTTP/2 client when enabled, otherwise the pooled requests session"""
+        if self.http2_client is not None:
+            if isinstance(data, memoryview):
+                data = data.tobytes()  # httpx would iterate a memoryview as ints
+            return self.http2_client.request(method, path, content=data, headers=headers, timeout=timeout)
+        return self.session.request(
+            method,
+            f"{self.config['server_url']}{path}",
+            data=data,
+            headers=headers,
+            timeout=timeout
+        )
+
+    def open_http2_client(self):
+        if not self.config.get("http2", False):
+            return None
+        if httpx is None:
+            logger.warning("http2 is enabled but httpx is not installed, using HTTP/1.1")
+            return None
         try:
-            headers = {'Content-Type': 'application/octet-stream'}
+            return httpx.Client(http2=True, base_url=self.config["server_url"])
+        except ImportError:
+            logger.warning("http2 needs the h2 package (pip install 'httpx[http2]'), using HTTP/1.1")
+            return None
+
+    def process_audio(self, data):
+        """POST audio to the server; data is a bytes-like body or an iterator of chunks (sent chunked)"""
+        try:
+            sent_ns = []
+            if not isinstance(data, (bytes, memoryview)):
+                # Only open the request once the stream has produced audio
+                first_chunk = next(data, None)
+                if first_chunk is None:
+                    logger.info("Recording too short or silent, skipping")
+                    return
+                chunks = data
+                def body():
+                    yield first_chunk
+                    yield from chunks
+                    # Recording stopped and fully sent: the server's time starts here
+                    sent_ns.append(time.perf_counter_ns())
+                data = body()
+            
+            headers = {'Content-Type': 'application/octet-stream', 'X-Sample-Format': 's16le'}
             if self.config["api_key"]:
                 headers["x-api-key"] = self.config["api_key"]
             
-            start_time = datetime.now()
-            response = requests.post(
-                f"{self.config['server_url']}/transcribe",
-                data=audio_array.tobytes(),
+            start_ns = time.perf_counter_ns()
+            response = self.send_request(
+                "POST",
+                "/transcribe",
+                data=data,
                 headers=headers,
                 timeout=30
             )
             
             response.raise_for_status()
+            processing_time = (time.perf_counter_ns() - (sent_ns[-1] if sent_ns else start_ns)) / 1e9
+            logger.info(f"Server response time: {processing_time:.2f}s")
             result = response.json()
             text = result.get("text", "").strip()
             
             if text:
-                self.handle_output(text)
+                with self._output_lock:
+                    self.handle_output(text)
                 self.show_notification("Transcription", text[:100] + "..." if len(text) > 100 else text)
                 self.play_sound("stop")
             else:
                 logger.warning("Received empty transcription")
                 self.show_notification("STT Error", "Received empty transcription")
                 
-        except requests.exceptions.RequestException as e:
+        except NETWORK_ERRORS as e:
             logger.error(f"Network error: {e}")
             self.show_notification("STT Error", "Network connection failed")
         except Exception as e:
             logger.error(f"Processing error: {e}")
             self.show_notification("STT Error", "Processing failed")
 
+    def warm_connection(self):
+        """Open the pooled connection up front so the first transcription skips the handshake"""
+        try:
+            self.send_request("GET", "/health", timeout=5)
+        except NETWORK_ERRORS as e:
+            logger.warning(f"Server not reachable yet: {e}")
+
     def handle_output(self, text):
         try:
             # Always copy to clipboard
             pyperclip.copy(text)
             logger.info("Copied to clipboard")
             
-            # For macOS, we can use AppleScript to type
-            if self.config["output_mode"] in ["type", "both"]:
+            if self._do_type:
                 try:
-                    script = f'''
-                    tell application "System Events"
-                        keystroke "{text}"
-                    end tell
-                    '''
-                    subprocess.run(['osascript', '-e', script])
-                    logger.info("Text typed using AppleScript")
+                    if HAS_QUARTZ:
+                        self.type_text(text)
+                        logger.info("Text typed using Quartz events")
+                    else:
+                        # Without PyObjC, fall back to AppleScript
+                        escaped = text.replace('\\', '\\\\').replace('"', '\\"')
+                        script = f'''
+                        tell application "System Events"
+                            keystroke "{escaped}"
+                        end tell
+                        '''
+                        subprocess.run(['osascript', '-e', script])
+                        logger.info("Text typed using AppleScript")
                 except Exception as e:
                     logger.error(f"Error typing text: {e}")
                     
@@ -255,23 +549,39 @@ class MacSTTClient:
             logger.error(f"Output error: {e}")
             self.show_notification("STT Error", "Couldn't output text")
 
+    def type_text(self, text):
+        """Type text in-process by posting unicode keyboard events, 20 UTF-16 units at a time"""
+        def post(chunk, length):
+            for key_down in (True, False):
+                event = CGEventCreateKeyboardEvent(None, 0, key_down)
+                CGEventKeyboardSetUnicodeString(event, length, chunk)
+                CGEventPost(kCGHIDEventTap, event)
+
+        chunk, length = "", 0
+        for ch in text:
+            # Characters outside the BMP take a surrogate pair; never split one across events
+            width = 2 if ord(ch) > 0xFFFF else 1
+            if length + width > 20:
+                post(chunk, length)
+                chunk, length = "", 0
+            chunk += ch
+            length += width
+        if chunk:
+            post(chunk, length)
+
     def monitor_logs_for_permission_warnings(self):
         """
         Set up a log handler to detect accessibility permission warnings
         """
-        class WarningDetector(logging.Handler):
-            def __init__(self, client):
-                super().__init__()
-                self.client = client
-                
-            def emit(self, record):
-                if record.levelno == logging.WARNING and "not trusted" in record.getMessage() and "accessibility" in record.getMessage():
-                    self.client.accessibility_permission_warning = True
-        
-        # Add our custom handler to the pynput.keyboard logger
-        warning_detector = WarningDetector(self)
+        # Add our custom handler to the pynput.keyboard logger only once; later runs just retarget it
         pynput_logger = logging.getLogger("pynput.keyboard")
-        pynput_logger.addHandler(warning_detector)
+        warning_detector = getattr(pynput_logger, "_stt_warning_detector", None)
+        if warning_detector is None:
+            warning_detector = WarningDetector(self)
+            pynput_logger.addHandler(warning_detector)
+            pynput_logger._stt_warning_detector = warning_detector
+        else:
+            warning_detector.client = self
 
     def run(self):
         try:
@@ -287,6 +597,7 @@ class MacSTTClient:
             
             # Start the listener
             listener.start()
+            self.warm_connection()
             
             # Check for accessibility warnings
             time.sleep(1)  # Give time for warnings to appear
@@ -296,14 +607,20 @@ class MacSTTClient:
             else:
                 self.show_notification("STT Client", "Ready to transcribe")
             
-            while True:
-                time.sleep(0.1)
+            # Block until interrupted or terminated instead of polling
+            self._stop = threading.Event()
+            signal.signal(signal.SIGTERM, lambda *_: self._stop.set())
+            self._stop.wait()
+            logger.info("Terminated, exiting...")
                 
         except KeyboardInterrupt:
             logger.info("Exiting...")
         except Exception as e:
             logger.error(f"Fatal error: {e}")
             self.show_notification("STT Error", "Client crashed")
+        finally:
+            # Let an in-flight streaming upload finish so the executor can shut down
+            self._take.done.set()
 
 def configure():
     config_path = os.path.expanduser('~/.config/stt_client/config.yaml')
@@ -331,7 +648,7 @@ def configure():
     config["output_mode"] = ["clipboard", "type", "both"][int(mode)-1] if mode in ["1","2","3"] else "clipboard"
     
     with open(config_path, 'w') as f:
-        yaml.dump(config, f)
+        yaml.dump(config, f, Dumper=_Dumper)
     
     print(f"\nConfiguration saved to: {config_path}")
 
@@ -0,0 +1,54 @@
+"""Clip layout for batched transcription.
+
+Recordings batched together are laid end to end on one timeline and cut into clips that
+faster-whisper decodes in a single call; these helpers build the clips and map the
+resulting segments back to the recording they came from. Kept free of heavy imports so
+they can be tested without a model.
+"""
+import bisect
+
+# Whisper's context window; longer recordings are split into clips of this length
+CLIP_SECONDS = 30
+# Slack when matching batched segment start times (rounded to 1 ms) back to their clip
+SEGMENT_TIME_TOLERANCE = 0.001
+
+def pack_clips(regions):
+    """Merge consecutive (start, end) regions in seconds into clips no longer than CLIP_SECONDS"""
+    clips = []
+    for start, end in regions:
+        if clips and end - clips[-1][0] <= CLIP_SECONDS:
+            clips[-1] = (clips[-1][0], end)
+            continue
+        while end - start > CLIP_SECONDS:
+            clips.append((start, start + CLIP_SECONDS))
+            start += CLIP_SECONDS
+        clips.append((start, end))
+    return clips
+
+def lay_out_clips(regions, lengths, sample_rate):
+    """Place each recording's (start, end) regions on the concatenated timeline.
+
+    regions[i] holds recording i's regions in seconds and lengths[i] its length in samples.
+    Returns the clip_timestamps dicts (seconds) and the recording index owning each clip.
+    """
+    clips = []
+    owners = []
+    offset = 0
+    for index, (recording_regions, length) in enumerate(zip(regions, lengths)):
+        for start, end in pack_clips(recording_regions):
+            clips.append({"start": offset / sample_rate + start, "end": offset / sample_rate + end})
+            owners.append(index)
+        offset += length
+    return clips, owners
+
+def segment_owners(clips, owners, starts):
+    """Recording index for each batched segment start time in seconds.
+
+    faster-whisper truncates clip starts to whole samples and rounds segment times to 1 ms,
+    so a segment at the very start of a clip can read up to 0.5 ms before it.
+    """
+    clip_starts = [clip["start"] for clip in clips]
+    return [
+        owners[max(bisect.bisect_right(clip_starts, start + SEGMENT_TIME_TOLERANCE) - 1, 0)]
+        for start in starts
+    ]
@@ -7,11 +7,28 @@ import numpy as np
 import torch
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from faster_whisper import WhisperModel
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
+from faster_whisper import WhisperModel, BatchedInferencePipeline
+from faster_whisper.vad import VadOptions, get_speech_timestamps
 import uvicorn
 import logging
-from datetime import datetime
+import asyncio
+import bisect
+import queue
+import threading
+import json
+import orjson
+from stt_clips import lay_out_clips, segment_owners
+import time
 import sys
+import importlib.util
+
+try:
+    from yaml import CSafeLoader as _Loader, CSafeDumper as _Dumper
+except ImportError:
+    from yaml import SafeLoader as _Loader, SafeDumper as _Dumper
 
 # Configure logging
 logging.basicConfig(
@@ -24,14 +41,116 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Micro-batching: concurrent requests arriving within MAX_BATCH_WAIT seconds are decoded together
+MAX_BATCH_SIZE = 8
+MAX_BATCH_WAIT = 0.03
+# Duration bucket edges in seconds (<10 s, 10-30 s, >30 s)
+DURATION_BUCKETS = (10, 30)
+# Greedy decoding by default: beam search costs ~beam_size x decoder work for little gain on dictation
+DEFAULT_BEAM_SIZE = 1
+VAD_OPTIONS = VadOptions(min_silence_duration_ms=500)
+# Largest accepted upload; 40 MB is about ten minutes of 16 kHz float32 PCM
+DEFAULT_MAX_UPLOAD_MB = 40
+
+def _load_yaml_json_cached(path):
+    """Load a YAML file via its JSON sidecar when that was made from this exact version of it.
+    
+    The sidecar records the YAML's mtime and size; an ordering check alone would keep serving
+    a stale sidecar after an older config is restored with its timestamps (cp -p, rsync -t).
+    """
+    json_path = os.path.splitext(path)[0] + ".json"
+    st = os.stat(path)
+    source = [st.st_mtime_ns, st.st_size]
+    try:
+        with open(json_path, "rb") as f:
+            cached = orjson.loads(f.read())
+        if isinstance(cached, dict) and cached.get("source") == source:
+            return cached["config"]
+    except (OSError, KeyError, orjson.JSONDecodeError):
+        pass  # Missing, unreadable or old-format sidecar, parse the YAML instead
+    
+    with open(path) as f:
+        config = yaml.load(f, Loader=_Loader)
+    try:
+        tmp_path = json_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(orjson.dumps({"source": source, "config": config}))
+        os.replace(tmp_path, json_path)
+    except (OSError, TypeError) as e:
+        logger.debug(f"Couldn't write config cache {json_path}: {e}")
+    return config
+
+def _resolve(future, result, error):
+    """Complete a request's future on its event loop, unless the client already went away"""
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+class GPUFeatureExtractor:
+    """Drop-in for faster-whisper's FeatureExtractor that computes the log-mel spectrogram with CUDA.
+    
+    The Hann window and mel filter bank are moved to the GPU once; any other attribute is
+    read from the wrapped CPU extractor.
+    """
+    def __init__(self, extractor, device="cuda", compile=False):
+        self.extractor = extractor
+        self.device = device
+        self.window = torch.hann_window(extractor.n_fft, device=device)
+        self.mel_filters = torch.as_tensor(extractor.mel_filters, dtype=torch.float32, device=device)
+        self.log_mel = self._log_mel
+        if compile and hasattr(torch, "compile"):
+            # Fuses the elementwise tail into a few kernels; dynamic because clip lengths vary
+            self.log_mel = torch.compile(self._log_mel, dynamic=True)
+    
+    def __getattr__(self, name):
+        return getattr(self.extractor, name)
+    
+    def __call__(self, waveform, padding=160, chunk_length=None):
+        if chunk_length is not None:
+            self.extractor.n_samples = chunk_length * self.extractor.sampling_rate
+            self.extractor.nb_max_frames = self.extractor.n_samples // self.extractor.hop_length
+        if not waveform.flags.writeable:
+            waveform = np.array(waveform)  # torch can't wrap a read-only buffer
+        
+        with torch.inference_mode():
+            audio = torch.from_numpy(waveform).to(self.device, dtype=torch.float32, non_blocking=True)
+            if padding:
+                audio = torch.nn.functional.pad(audio, (0, padding))
+            try:
+                log_spec = self.log_mel(audio)
+            except Exception as e:
+                if self.log_mel is self._log_mel:
+                    raise
+                logger.warning(f"Compiled log-mel failed, falling back to eager mode: {e}")
+                self.log_mel = self._log_mel
+                log_spec = self.log_mel(audio)
+            return log_spec.cpu().numpy()
+    
+    def _log_mel(self, audio):
+        stft = torch.stft(audio, self.extractor.n_fft, self.extractor.hop_length, window=self.window, return_complex=True)
+        magnitudes = stft[..., :-1].abs() ** 2
+        log_spec = torch.clamp(self.mel_filters @ magnitudes, min=1e-10).log10()
+        log_spec = torch.maximum(log_spec, log_spec.max() - 8.0)
+        return (log_spec + 4.0) / 4.0
+
 class STTServer:
     def __init__(self):
         self.config = self.load_config()
         self.model = None
+        self.batched_model = None
         self.sample_rate = 16000
+        self.queue = queue.Queue()
+        self._pin_staging = False
         self.load_model()
+        # Persistent staging buffer for batched audio (60 s to start), reused across batches
+        self._staging = self.alloc_staging(self.sample_rate * 60)
+        self._worker = threading.Thread(target=self.batch_worker, name="stt-gpu", daemon=True)
+        self._worker.start()
     
-    def load_config(self):
+    def load_config(self, retry=True):
         config_path = os.path.expanduser("~/.config/stt_server/config.yaml")
         try:
             os.makedirs(os.path.dirname(config_path), exist_ok=True)
@@ -46,26 +165,37 @@ class STTServer:
                     "api_key": None
                 }
                 with open(config_path, "w") as f:
-                    yaml.dump(default_config, f)
+                    yaml.dump(default_config, f, Dumper=_Dumper)
                 return default_config
             
-            with open(config_path) as f:
-                config = yaml.safe_load(f)
-                if 'compute_type' not in config:
-                    config['compute_type'] = "float16" if config.get('use_gpu', True) else "float32"
-                return config
+            config = _load_yaml_json_cached(config_path)
+            if 'compute_type' not in config:
+                config['compute_type'] = "float16" if config.get('use_gpu', True) else "int8"
+            elif not config.get('use_gpu', True) and config['compute_type'] == "float16":
+                # float16 fails on most CPUs; int8 is the fast CPU path
+                config['compute_type'] = "int8"
+            return config
         except Exception as e:
             logger.error(f"Error loading config: {e}")
-            return self.load_config()
+            if retry:
+                return self.load_config(retry=False)
+            logger.critical(f"Fix or remove {config_path} and restart")
+            sys.exit(2)
     
     def load_model(self):
         try:
             use_gpu = self.config["use_gpu"] and torch.cuda.is_available()
             device = "cuda" if use_gpu else "cpu"
             compute_type = self.config["compute_type"]
+            if not use_gpu and compute_type in ("float16", "int8_float16"):
+                # CUDA unavailable: half precision isn't supported on most CPUs, use INT8 instead
+                compute_type = "int8"
             
-            # Model selection logic
-            model_name = "large-v3-turbo" if use_gpu else "small"
+            # Distilled models decode ~2x faster at similar English WER; the CPU default is an
+            # English-only checkpoint, so there are no multilingual weights to carry
+            model_name = self.config.get("model") or (
+                "distil-large-v3" if use_gpu else "Systran/faster-distil-whisper-small.en"
+            )
             logger.info(f"Selected model: {model_name} for device: {device}")
             
             logger.info(f"Loading faster-whisper model {model_name} on {device} ({compute_type})...")
@@ -74,37 +204,237 @@ class STTServer:
                 model_size_or_path=model_name,
                 device=device,
                 compute_type=compute_type,
+                cpu_threads=os.cpu_count() or 0,
+                # Two workers share the weights on one GPU, so batched and streamed requests overlap
+                num_workers=2 if use_gpu else 1,
                 download_root=os.path.expanduser("~/.cache/whisper")
             )
+            if use_gpu and self.config.get("gpu_features", True):
+                # Both the batched and streaming paths call model.feature_extractor per clip
+                self.model.feature_extractor = GPUFeatureExtractor(
+                    self.model.feature_extractor,
+                    compile=self.config.get("compile_features", True)
+                )
+                logger.info("Computing log-mel features on the GPU")
+                # Batched clips are slices of the staging buffer, which the extractor copies to
+                # the GPU; page-locked memory lets those copies run asynchronously
+                self._pin_staging = True
+            self.batched_model = BatchedInferencePipeline(model=self.model)
+            self.warmup()
             logger.info("Model loaded successfully")
         except Exception as e:
             logger.error(f"Error loading model: {e}")
             raise
     
-    def transcribe_audio(self, audio_array):
+    def warmup(self):
+        """Decode one second of silence so the first request doesn't pay for lazy CUDA and compile setup"""
+        start = time.perf_counter()
+        segments, _ = self.model.transcribe(
+            np.zeros(self.sample_rate, dtype=np.float32),
+            language="en",
+            beam_size=DEFAULT_BEAM_SIZE
+        )
+        list(segments)  # The generator is lazy; decoding only happens when it is consumed
+        logger.info(f"Warmup took {time.perf_counter() - start:.2f}s")
+    
+    async def transcribe_audio(self, audio_array, params):
+        """Queue audio for the GPU worker thread and wait for its transcription"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.queue.put((audio_array, params, future, loop))
+        return await future
+    
+    def batch_worker(self):
+        """Collect queued requests for up to MAX_BATCH_WAIT and transcribe each bucket in one call.
+        
+        Runs on its own thread so the event loop only parses requests; results go back to
+        each request's loop with call_soon_threadsafe.
+        """
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + MAX_BATCH_WAIT
+            while len(batch) < MAX_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            # Group by duration so short clips don't pay for padding next to long ones,
+            # and by decoding options since one call shares them
+            buckets = {}
+            for item in batch:
+                duration = len(item[0]) / self.sample_rate
+                key = (bisect.bisect(DURATION_BUCKETS, duration), tuple(sorted(item[1].items())))
+                buckets.setdefault(key, []).append(item)
+            
+            for items in buckets.values():
+                self.run_bucket(items)
+    
+    def run_bucket(self, items):
+        """Transcribe one bucket and resolve its futures; if the batch fails, retry each request alone"""
         try:
-            start_time = datetime.now()
-            segments, info = self.model.transcribe(
-                audio_array,
+            results = self.transcribe_batch([audio for audio, _, _, _ in items], items[0][1])
+        except Exception as e:
+            if len(items) > 1:
+                # One bad upload shouldn't fail every request batched with it
+                logger.warning(f"Batch of {len(items)} failed ({e}), retrying requests individually")
+                for item in items:
+                    self.run_bucket([item])
+                return
+            logger.error(f"Transcription error: {e}")
+            _, _, future, loop = items[0]
+            error = HTTPException(status_code=500, detail=f"Transcription error: {e}")
+            loop.call_soon_threadsafe(_resolve, future, None, error)
+            return
+        for (_, _, future, loop), result in zip(items, results):
+            loop.call_soon_threadsafe(_resolve, future, result, None)
+    
+    async def stream_segments(self, audio_array, params):
+        """Yield one NDJSON line per segment as soon as the decoder produces it"""
+        segments, _ = await run_in_threadpool(
+            self.model.transcribe,
+            audio_array,
+            language="en",
+            beam_size=params["beam_size"],
+            best_of=params["best_of"],
+            condition_on_previous_text=False,
+            vad_filter=params["vad_filter"],
+            vad_parameters=VAD_OPTIONS
+        )
+        while True:
+            segment = await run_in_threadpool(next, segments, None)
+            if segment is None:
+                break
+            yield orjson.dumps({"segment": segment.text, "start": segment.start, "end": segment.end}) + b"\n"
+    
+    def alloc_staging(self, size):
+        """Float32 staging buffer, pinned when its clips are copied to the GPU for features"""
+        if self._pin_staging:
+            # The array's base keeps the pinned tensor alive
+            return torch.empty(size, dtype=torch.float32, pin_memory=True).numpy()
+        return np.empty(size, dtype=np.float32)
+    
+    def stage(self, audios, total):
+        """Concatenate audios into the reused staging buffer, growing it only when a batch is larger"""
+        if total > self._staging.size:
+            self._staging = self.alloc_staging(max(total, self._staging.size * 2))
+        return np.concatenate(audios, out=self._staging[:total])
+    
+    def transcribe_batch(self, audios, params):
+        """Transcribe several recordings with one batched decode.
+        
+        The recordings are laid end to end and each is cut into clips of at most
+        CLIP_SECONDS (only its voiced regions when vad_filter is set), so all clips are
+        decoded together; segments are mapped back to their clip, and so their recording,
+        by start time.
+        """
+        start_time = time.perf_counter()
+        regions = []
+        for audio in audios:
+            if params["vad_filter"]:
+                regions.append([
+                    (ts["start"] / self.sample_rate, ts["end"] / self.sample_rate)
+                    for ts in get_speech_timestamps(audio, VAD_OPTIONS)
+                ])
+            else:
+                regions.append([(0.0, len(audio) / self.sample_rate)])
+        clips, clip_owners = lay_out_clips(regions, [len(audio) for audio in audios], self.sample_rate)
+        
+        texts = [[] for _ in audios]
+        language, language_probability = "en", 0.0
+        if clips:
+            segments, info = self.batched_model.transcribe(
+                self.stage(audios, sum(len(audio) for audio in audios)),
                 language="en",
-                beam_size=5
+                beam_size=params["beam_size"],
+                best_of=params["best_of"],
+                clip_timestamps=clips,
+                batch_size=MAX_BATCH_SIZE
             )
-            text = " ".join([segment.text for segment in segments])
-            processing_time = (datetime.now() - start_time).total_seconds()
-            
-            logger.info(f"Transcription completed in {processing_time:.2f}s")
-            logger.info(f"Detected language: {info.language} (confidence: {info.language_probability:.2f})")
-            logger.info(f"Transcription length: {len(text)} characters")
-            
-            return {
-                "text": text.strip(),
-                "language": info.language,
-                "language_probability": info.language_probability,
+            segments = list(segments)
+            for segment, index in zip(segments, segment_owners(clips, clip_owners, [s.start for s in segments])):
+                texts[index].append(segment.text)
+            language, language_probability = info.language, info.language_probability
+        processing_time = time.perf_counter() - start_time
+        
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(f"Transcribed batch of {len(audios)} ({len(clips)} clips) in {processing_time:.2f}s")
+            logger.info(f"Detected language: {language} (confidence: {language_probability:.2f})")
+        
+        return [
+            {
+                "text": " ".join(parts).strip(),
+                "language": language,
+                "language_probability": language_probability,
                 "processing_time": processing_time
             }
-        except Exception as e:
-            logger.error(f"Transcription error: {e}")
-            raise HTTPException(status_code=500, detail=f"Transcription error: {e}")
+            for parts in texts
+        ]
+
+def parse_params(request):
+    """Decoding options from the query string, overridden by a JSON X-STT-Params header"""
+    params = dict(request.query_params)
+    header = request.headers.get("x-stt-params")
+    if header:
+        params.update(json.loads(header))
+    return {
+        "beam_size": max(1, int(params.get("beam_size", DEFAULT_BEAM_SIZE))),
+        "best_of": max(1, int(params.get("best_of", 1))),
+        "vad_filter": str(params.get("vad_filter", True)).lower() not in ("0", "false", "no")
+    }
+
+async def read_body(request, max_bytes):
+    """Read the upload straight into one buffer, preallocated from Content-Length when it is sent.
+    
+    Bodies over max_bytes are rejected with 413, before allocating when the length is declared.
+    """
+    length = request.headers.get("content-length", "")
+    if not length.isdigit():
+        # Chunked upload (the streaming client), so the size is only known at the end
+        buf = bytearray()
+        async for chunk in request.stream():
+            buf += chunk
+            if len(buf) > max_bytes:
+                raise HTTPException(status_code=413, detail=f"Upload larger than {max_bytes} bytes")
+        return buf
+    
+    if int(length) > max_bytes:
+        raise HTTPException(status_code=413, detail=f"Upload larger than {max_bytes} bytes")
+    buf = bytearray(int(length))
+    view = memoryview(buf)
+    offset = 0
+    async for chunk in request.stream():
+        end = offset + len(chunk)
+        if end > len(buf):
+            raise HTTPException(status_code=400, detail="Body longer than Content-Length")
+        view[offset:end] = chunk
+        offset = end
+    return view[:offset]
+
+def is_pcm16(headers):
+    """True if the body is 16-bit PCM (X-Sample-Format: s16le or Content-Type: audio/pcm;bits=16)"""
+    if headers.get("x-sample-format") == "s16le":
+        return True
+    content_type = headers.get("content-type", "").replace(" ", "").lower()
+    return content_type.startswith("audio/pcm") and "bits=16" in content_type
+
+def decode_pcm(audio_data, headers):
+    """Decode the request body into the float32 [-1, 1] samples Whisper expects"""
+    if not is_pcm16(headers):
+        return np.frombuffer(audio_data, dtype=np.float32)
+    # 16-bit PCM halves the upload; convert and scale in one pass straight into the float32 output
+    audio_i16 = np.frombuffer(audio_data, dtype=np.int16)
+    return np.multiply(audio_i16, 1.0 / 32768.0, out=np.empty(audio_i16.size, dtype=np.float32), dtype=np.float32)
+
+class Transcription(BaseModel):
+    """/transcribe response; a declared model is serialized by pydantic-core without the stdlib json encoder"""
+    text: str
+    language: str
+    language_probability: float
+    processing_time: float
 
 app = FastAPI()
 server = STTServer()
@@ -117,11 +447,16 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-@app.post("/transcribe")
+@app.get("/health")
+async def health():
+    return {"status": "ok"}
+
+@app.post("/transcribe", response_model=Transcription)
 async def transcribe(request: Request):
     # Log request
     client_ip = request.client.host if request.client else "unknown"
-    logger.info(f"Received request from {client_ip}, content length: {request.headers.get('content-length')}")
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(f"Received request from {client_ip}, content length: {request.headers.get('content-length')}")
     
     # Optional API key authentication
     if server.config["api_key"]:
@@ -131,22 +466,36 @@ async def transcribe(request: Request):
     
     try:
         # Receive audio data as numpy array
-        audio_data = await request.body()
-        logger.debug(f"Received audio data size: {len(audio_data)} bytes")
+        audio_data = await read_body(request, int(server.config.get("max_upload_mb", DEFAULT_MAX_UPLOAD_MB) * 1024 * 1024))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Received audio data size: {len(audio_data)} bytes")
         
         try:
-            audio_array = np.frombuffer(audio_data, dtype=np.float32)
-            logger.debug(f"Audio array shape: {audio_array.shape}")
+            audio_array = decode_pcm(audio_data, request.headers)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Audio array shape: {audio_array.shape}")
             
             if audio_array.size == 0:
                 logger.error("Received empty audio data")
                 raise HTTPException(status_code=400, detail="Empty audio data")
                 
-            result = server.transcribe_audio(audio_array)
+            params = parse_params(request)
+            if request.query_params.get("stream", "0").lower() in ("1", "true", "yes"):
+                # Per-segment NDJSON, unbatched so the first words arrive before decoding finishes
+                return StreamingResponse(
+                    server.stream_segments(audio_array, params),
+                    media_type="application/x-ndjson"
+                )
+            
+            result = await server.transcribe_audio(audio_array, params)
             return result
+        except HTTPException:
+            raise
         except Exception as e:
             logger.error(f"Audio processing error: {e}")
             raise HTTPException(status_code=400, detail=f"Audio processing error: {e}")
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Request processing error: {e}")
         raise HTTPException(status_code=500, detail=f"Server error: {e}")
@@ -174,7 +523,7 @@ def configure():
     config["api_key"] = api_key
     
     with open(config_path, "w") as f:
-        yaml.dump(config, f)
+        yaml.dump(config, f, Dumper=_Dumper)
     
     print(f"Configuration saved to {config_path}")
 
@@ -199,7 +548,12 @@ def main():
                 app,
                 host=server.config["host"],
                 port=server.config["port"],
-                log_level="debug" if args.debug else "info"
+                log_level="debug" if args.debug else "info",
+                loop="uvloop" if importlib.util.find_spec("uvloop") else "asyncio",
+                http="httptools" if importlib.util.find_spec("httptools") else "h11",
+                access_log=False,
+                workers=1,  # One process owns the GPU model
+                timeout_keep_alive=75
             )
         except Exception as e:
             logger.critical(f"Fatal error: {e}")
@@ -3,24 +3,56 @@ import os
 import argparse
 import yaml
 from pynput import keyboard
-import sounddevice as sd
-import numpy as np
-import torch
-import pyperclip
 import subprocess
+import ctypes
+import ctypes.util
+import mmap
 from pathlib import Path
 import time
+import sys
+import threading
+
+try:
+    from yaml import CSafeLoader as _Loader, CSafeDumper as _Dumper
+except ImportError:
+    from yaml import SafeLoader as _Loader, SafeDumper as _Dumper
+
+# Capacity of the mmap-backed buffer recordings move to once they outgrow the first 60 s
+MMAP_SECONDS = 600
+
+# libxdo's CURRENTWINDOW: type into whichever window has focus
+CURRENTWINDOW = 0
+
+def load_libxdo():
+    """Bind libxdo once so typing doesn't fork xdotool; None if the library is missing"""
+    try:
+        libxdo = ctypes.CDLL(ctypes.util.find_library("xdo") or "libxdo.so.3")
+    except OSError:
+        return None
+    libxdo.xdo_new.restype = ctypes.c_void_p
+    libxdo.xdo_new.argtypes = [ctypes.c_char_p]
+    libxdo.xdo_enter_text_window.restype = ctypes.c_int
+    libxdo.xdo_enter_text_window.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.c_char_p, ctypes.c_uint32]
+    xdo = libxdo.xdo_new(None)
+    if not xdo:
+        return None
+    return libxdo, xdo
 
 class STTShortcut:
     def __init__(self):
+        import numpy as np
         self.config = self.load_config()
         self.model = None
         self.is_recording = False
-        self.audio_data = []
         self.sample_rate = 16000
-        self.load_model()
+        # Contiguous capture buffer (60 seconds), grown on demand by the audio callback
+        self._buf = np.empty(self.sample_rate * 60, dtype=np.float32)
+        self._buf_pos = 0
+        self.xdo = load_libxdo() if os.getenv("XDG_SESSION_TYPE") == "x11" else None
+        # Set once load_model has finished (or failed); run() loads it after binding the hotkey
+        self._model_ready = threading.Event()
         
-    def load_config(self):
+    def load_config(self, retry=True):
         config_path = os.path.expanduser("~/.config/stt_shortcut/config.yaml")
         try:
             os.makedirs(os.path.dirname(config_path), exist_ok=True)
@@ -35,25 +67,35 @@ class STTShortcut:
                     "compute_type": "float16"  # Added for faster-whisper
                 }
                 with open(config_path, "w") as f:
-                    yaml.dump(default_config, f)
+                    yaml.dump(default_config, f, Dumper=_Dumper)
                 return default_config
             
             with open(config_path) as f:
-                config = yaml.safe_load(f)
+                config = yaml.load(f, Loader=_Loader)
                 if isinstance(config['hotkey'], str) and 'space' in config['hotkey'] and '<space>' not in config['hotkey']:
                     config['hotkey'] = config['hotkey'].replace('space', '<space>')
                 if 'compute_type' not in config:
-                    config['compute_type'] = "float16" if config.get('use_gpu', True) else "float32"
+                    config['compute_type'] = "float16" if config.get('use_gpu', True) else "int8"
+                elif not config.get('use_gpu', True) and config['compute_type'] == "float16":
+                    # float16 fails on most CPUs; int8 is the fast CPU path
+                    config['compute_type'] = "int8"
                 return config
         except Exception as e:
             print(f"Error loading config: {e}")
-            return self.load_config()
+            if retry:
+                return self.load_config(retry=False)
+            print(f"Fix or remove {config_path} and restart")
+            sys.exit(2)
     
     def load_model(self):
+        import torch
         try:
             from faster_whisper import WhisperModel
             device = "cuda" if (self.config["use_gpu"] and torch.cuda.is_available()) else "cpu"
             compute_type = self.config["compute_type"]
+            if device == "cpu" and compute_type in ("float16", "int8_float16"):
+                # CUDA unavailable: half precision isn't supported on most CPUs, use INT8 instead
+                compute_type = "int8"
             
             print(f"Loading faster-whisper model {self.config['model']} on {device} ({compute_type})...")
             
@@ -61,6 +103,8 @@ class STTShortcut:
                 model_size_or_path=self.config["model"],
                 device=device,
                 compute_type=compute_type,
+                cpu_threads=os.cpu_count() or 0,
+                num_workers=1,
                 download_root=os.path.expanduser("~/.cache/whisper")
             )
             print("Model loaded successfully")
@@ -79,14 +123,20 @@ class STTShortcut:
             self.start_recording()
     
     def start_recording(self):
+        import sounddevice as sd
         self.is_recording = True
-        self.audio_data = []
+        self._buf_pos = 0
         print("\nRecording started... (Press hotkey again to stop)")
         
         def callback(indata, frames, time, status):
             if status:
                 print(status)
-            self.audio_data.append(indata.copy())
+            end = self._buf_pos + frames
+            if end > self._buf.size:
+                self._grow(end)
+            # Mono float32 block: reshape is a view, so this is a single memcpy
+            self._buf[self._buf_pos:end] = indata.reshape(-1)
+            self._buf_pos = end
         
         self.stream = sd.InputStream(
             samplerate=self.sample_rate,
@@ -97,20 +147,42 @@ class STTShortcut:
         )
         self.stream.start()
     
+    def _grow(self, min_size):
+        """Move the capture buffer to an anonymous mmap of at least min_size samples.
+        
+        Mapped pages are only faulted in when written, so the 10-minute mapping costs
+        memory in proportion to what is actually recorded.
+        """
+        import numpy as np
+        size = max(min_size, self.sample_rate * MMAP_SECONDS, self._buf.size * 2)
+        new_buf = np.frombuffer(mmap.mmap(-1, size * np.dtype(np.float32).itemsize), dtype=np.float32)
+        new_buf[:self._buf_pos] = self._buf[:self._buf_pos]
+        self._buf = new_buf
+    
     def stop_recording(self):
         self.is_recording = False
         self.stream.stop()
         self.stream.close()
         print("Recording stopped. Processing...")
         
-        audio_array = np.concatenate(self.audio_data)
-        audio_array = audio_array.flatten().astype(np.float32)
+        if not self._model_ready.is_set():
+            print("Waiting for the model to finish loading...")
+            self._model_ready.wait()
+        if self.model is None:
+            print("Model failed to load, discarding recording")
+            return
+        
+        audio_array = self._buf[:self._buf_pos]
         
         try:
             segments, info = self.model.transcribe(
                 audio_array,
                 language="en",
-                beam_size=5  # Adjust for accuracy/speed tradeoff
+                beam_size=1,  # Greedy decoding; dictation is short, raise for accuracy
+                best_of=1,
+                condition_on_previous_text=False,
+                vad_filter=True,
+                vad_parameters=dict(min_silence_duration_ms=500)
             )
             
             # Concatenate all segments
@@ -124,6 +196,7 @@ class STTShortcut:
             print(f"Error during transcription: {e}")
     
     def handle_output(self, text):
+        import pyperclip
         if self.config["output_mode"] == "clipboard":
             pyperclip.copy(text)
             print("Text copied to clipboard")
@@ -136,8 +209,7 @@ class STTShortcut:
                     pyperclip.copy(text)
                     return
                 
-                subprocess.run(["sleep", "0.1"])
-                subprocess.run(["xdotool", "type", "--delay", "0", text])
+                self.type_text(text)
             except Exception as e:
                 print(f"Error using xdotool: {e}. Falling back to clipboard.")
                 pyperclip.copy(text)
@@ -145,32 +217,52 @@ class STTShortcut:
             pyperclip.copy(text)
             try:
                 if os.getenv("XDG_SESSION_TYPE") == "x11":
-                    subprocess.run(["sleep", "0.1"])
-                    subprocess.run(["xdotool", "type", "--delay", "0", text])
+                    self.type_text(text)
             except:
                 pass
     
+    def type_text(self, text):
+        # Optional settle time for window managers that need focus to catch up
+        type_delay = self.config.get("type_delay", 0)
+        if type_delay:
+            time.sleep(type_delay)
+        if self.xdo is not None:
+            libxdo, xdo = self.xdo
+            if libxdo.xdo_enter_text_window(xdo, CURRENTWINDOW, text.encode("utf-8"), 0) != 0:
+                raise RuntimeError("libxdo failed to type text")
+        else:
+            subprocess.run(["xdotool", "type", "--delay", "0", text])
+    
     def run(self):
+        key_combination = self.config["hotkey"]
         try:
-            key_combination = self.config["hotkey"]
             listener = keyboard.GlobalHotKeys({
                 key_combination: self.toggle_recording
             })
-            
-            print(f"STT Shortcut running. Press {key_combination} to start/stop recording.")
-            print(f"Configuration: {self.config}")
-            
-            listener.start()
-            while True:
-                time.sleep(0.1)
-                pass
         except ValueError as e:
             print(f"\nERROR: Invalid hotkey format in config: {self.config['hotkey']}")
             print("Edit ~/.config/stt_shortcut/config.yaml to fix this")
+            return
+        
+        try:
+            with listener:
+                print(f"STT Shortcut running. Press {key_combination} to start/stop recording.")
+                print(f"Configuration: {self.config}")
+                
+                # The hotkey is bound before the model loads, so a recording can start meanwhile;
+                # stop_recording waits for the model before transcribing
+                try:
+                    self.load_model()
+                finally:
+                    self._model_ready.set()
+                
+                # Block on the listener thread instead of polling; the with-block stops it on exit
+                listener.join()
         except KeyboardInterrupt:
             print("\nExiting...")
 
 def configure():
+    import sounddevice as sd
     config_path = os.path.expanduser("~/.config/stt_shortcut/config.yaml")
     os.makedirs(os.path.dirname(config_path), exist_ok=True)
     
@@ -203,7 +295,7 @@ def configure():
     config["record_on_press"] = False
     
     with open(config_path, "w") as f:
-        yaml.dump(config, f)
+        yaml.dump(config, f, Dumper=_Dumper)
     
     print(f"Configuration saved to {config_path}")
 
@@ -227,5 +319,4 @@ def main():
                 print("Try installing faster-whisper manually: pip install faster-whisper")
 
 if __name__ == "__main__":
-    import sys
     main()
\ No newline at end of file
@@ -0,0 +1,55 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stt_clips import CLIP_SECONDS, lay_out_clips, pack_clips, segment_owners
+
+SAMPLE_RATE = 16000
+
+def whisper_segment_start(clip, offset_in_clip=0.0):
+    """A segment start as faster-whisper reports it: clip start truncated to a sample, rounded to 1 ms"""
+    return round(int(clip["start"] * SAMPLE_RATE) / SAMPLE_RATE + offset_in_clip, 3)
+
+def whole_recordings(lengths):
+    return [[(0.0, length / SAMPLE_RATE)] for length in lengths]
+
+def test_pack_clips_merges_close_regions():
+    assert pack_clips([(0.0, 1.0), (2.0, 3.0)]) == [(0.0, 3.0)]
+
+def test_pack_clips_splits_long_regions():
+    assert pack_clips([(0.0, 2 * CLIP_SECONDS + 5)]) == [
+        (0.0, CLIP_SECONDS),
+        (CLIP_SECONDS, 2 * CLIP_SECONDS),
+        (2 * CLIP_SECONDS, 2 * CLIP_SECONDS + 5),
+    ]
+
+def test_pack_clips_starts_new_clip_past_window():
+    assert pack_clips([(0.0, 1.0), (29.5, 31.0)]) == [(0.0, 1.0), (29.5, 31.0)]
+
+def test_lay_out_clips_offsets_by_preceding_recordings():
+    clips, owners = lay_out_clips([[(0.0, 1.0)], [(0.5, 1.0)]], [SAMPLE_RATE * 2, SAMPLE_RATE], SAMPLE_RATE)
+    assert clips == [{"start": 0.0, "end": 1.0}, {"start": 2.5, "end": 3.0}]
+    assert owners == [0, 1]
+
+def test_segment_owners_at_sub_millisecond_boundary():
+    # 16001 samples puts the second recording at 1.0000625 s, which rounds to 1.0
+    lengths = [16001, SAMPLE_RATE * 31 + 7, 8003]
+    clips, owners = lay_out_clips(whole_recordings(lengths), lengths, SAMPLE_RATE)
+    assert owners == [0, 1, 1, 2]
+    starts = [whisper_segment_start(clip) for clip in clips]
+    assert segment_owners(clips, owners, starts) == owners
+
+def test_segment_owners_within_clips():
+    lengths = [24001, 40003]
+    clips, owners = lay_out_clips(whole_recordings(lengths), lengths, SAMPLE_RATE)
+    starts = [whisper_segment_start(clips[0], 0.8), whisper_segment_start(clips[1], 1.24)]
+    assert segment_owners(clips, owners, starts) == [0, 1]
+
+def test_segment_owners_skips_recordings_without_clips():
+    # The middle recording had no speech, so it has no clips and gets no segments
+    regions = [[(0.0, 1.0)], [], [(0.2, 0.9)]]
+    lengths = [16001, 16003, 16005]
+    clips, owners = lay_out_clips(regions, lengths, SAMPLE_RATE)
+    assert owners == [0, 2]
+    assert segment_owners(clips, owners, [whisper_segment_start(clip) for clip in clips]) == [0, 2]